@@ -1,32 +1,160 @@
-import json
+import hashlib
 import os
 import cv2
 from PyQt5.QtWidgets import (
     QApplication, QMainWindow, QWidget, QVBoxLayout, QHBoxLayout,
-    QLabel, QPushButton, QCheckBox, QFileDialog, QShortcut, QProgressBar,
+    QLabel, QPushButton, QCheckBox, QButtonGroup, QFileDialog, QShortcut, QProgressBar,
     QStyle, QStyleFactory
 )
-from PyQt5.QtGui import QPixmap, QImage, QKeySequence
-from PyQt5.QtCore import Qt, QTimer
+from PyQt5.QtGui import QPixmap, QPixmapCache, QImage, QImageReader, QImageIOHandler, QKeySequence, QPainter, QPen, QColor
+from PyQt5.QtCore import Qt, QTimer, QObject, QRunnable, QThreadPool, pyqtSignal
 import sys
 
+import orjson
+
+
+# 解码时的缩小倍数及对应的 OpenCV 标志，按倍数从大到小尝试
+_REDUCED_FLAGS = (
+    (8, cv2.IMREAD_REDUCED_COLOR_8),
+    (4, cv2.IMREAD_REDUCED_COLOR_4),
+    (2, cv2.IMREAD_REDUCED_COLOR_2),
+)
+
+# 自动保存日志中合法的分类值，空字符串表示取消分类
+_JOURNAL_VALUES = ("稀疏", "密集", "")
+
+
+def decode_scaled(image_path, target_width, target_height):
+    """按显示尺寸解码图像，返回 (QImage, scale)；无法读取时返回 (None, None)"""
+    # 先只读取文件头获取尺寸，用于选择解码时的缩小倍数
+    # 与 cv2.imread 一致按 EXIF Orientation 旋转，标注框坐标基于旋转后的图像
+    reader = QImageReader(image_path)
+    reader.setAutoTransform(True)
+    original_size = reader.size()  # 得到的是旋转前的尺寸
+    if not original_size.isValid() or original_size.isEmpty():
+        return None, None
+    if reader.transformation() & QImageIOHandler.TransformationRotate90:
+        original_size.transpose()
+    scaled_size = original_size.scaled(target_width, target_height, Qt.KeepAspectRatio)
+    width, height = scaled_size.width(), scaled_size.height()
+
+    # OpenCV 自带的 libjpeg-turbo 启用了 SIMD；IMREAD_REDUCED_COLOR_N 让 JPEG 在 IDCT 阶段直接缩小 N 倍
+    flag = cv2.IMREAD_COLOR
+    for factor, reduced_flag in _REDUCED_FLAGS:
+        if original_size.width() >= width * factor and original_size.height() >= height * factor:
+            flag = reduced_flag
+            break
+    image = cv2.imread(image_path, flag)
+    if image is None:
+        return None, None
+
+    # 缩放到精确的显示尺寸；原图超过显示尺寸 16 倍时剩余的缩小倍数会超过 2 倍，
+    # 因此缩小时一律用 INTER_AREA 避免细线和目标框边缘产生锯齿，放大时用双线性插值
+    if image.shape[1] != width or image.shape[0] != height:
+        shrinking = image.shape[1] > width or image.shape[0] > height
+        interpolation = cv2.INTER_AREA if shrinking else cv2.INTER_LINEAR
+        image = cv2.resize(image, (width, height), interpolation=interpolation)
+
+    # 直接按 BGR 解释 OpenCV 的缓冲区，转换为 QPainter 和 QPixmap 原生的 RGB32 格式（同时复制出数据）
+    q_image = QImage(image.data, width, height, 3 * width, QImage.Format_BGR888).convertToFormat(QImage.Format_RGB32)
+    return q_image, width / original_size.width()
+
+
+def draw_annotations(device, annotations, scale):
+    """在已缩放的图像上原地绘制标注"""
+    painter = QPainter(device)
+    painter.setPen(QPen(QColor(0, 255, 0), 2))
+    for ann in annotations:
+        bbox = ann["bbox"]  # [x, y, w, h]
+        category_id = ann["category_id"]
+        # 根据 category_id 映射到类别名称（如果需要更友好的显示，可完善 self.annot_data["categories"] 的解析）
+        category_name = f"类别 {category_id}"  
+
+        # 绘制矩形框
+        x, y, w, h = (int(v * scale) for v in bbox)
+        painter.drawRect(x, y, w, h)
+
+        # 绘制类别名称
+        painter.drawText(x, y - 10, category_name)
+    painter.end()
+
+
+def render_image(image_path, annotations, target_width, target_height):
+    """加载图像、绘制标注并缩放到目标尺寸，返回 QImage；加载失败返回 None
+
+    只使用 QImage，可以在后台线程中调用（QPixmap 只能在 GUI 线程中创建）
+    """
+    scaled_image, scale = decode_scaled(image_path, target_width, target_height)
+    if scaled_image is None:
+        return None
+    draw_annotations(scaled_image, annotations, scale)
+    return scaled_image
+
+
+class _PrefetchSignals(QObject):
+    """预取任务的信号（QRunnable 不是 QObject，不能直接定义信号）
+
+    finished 总会发出；加载失败时携带空的 QImage
+    """
+    finished = pyqtSignal(str, QImage)
+
+
+class _PrefetchJob(QRunnable):
+    """在线程池中预先渲染图像，结果通过信号排队回到 GUI 线程"""
+
+    def __init__(self, key, image_path, annotations, target_width, target_height):
+        super(_PrefetchJob, self).__init__()
+        self.key = key
+        self.image_path = image_path
+        self.annotations = annotations
+        self.target_width = target_width
+        self.target_height = target_height
+        self.signals = _PrefetchSignals()
+
+    def run(self):
+        q_image = render_image(self.image_path, self.annotations, self.target_width, self.target_height)
+        self.signals.finished.emit(self.key, q_image if q_image is not None else QImage())
+
 
 class COCOAnnotator(QMainWindow):
-    def __init__(self, image_dir, annot_path, parent=None):
+    def __init__(self, image_dir, annot_path, autosave_path=None, parent=None):
         super(COCOAnnotator, self).__init__(parent)
         self.image_dir = image_dir          # 图像文件夹路径（train2024 或 val2024）
         self.annot_path = annot_path        # 标注文件路径（instances_train2024.json 等）
+        # 自动保存日志路径：每次分类追加一行，程序异常退出也不会丢失进度
+        # 默认放在标注文件旁，该目录不可写（如只读数据集）时改放到用户主目录
+        if autosave_path is None:
+            autosave_path = os.path.splitext(annot_path)[0] + "_autosave.txt"
+            if not os.access(os.path.dirname(os.path.abspath(autosave_path)), os.W_OK):
+                # 文件名加上标注文件绝对路径的短哈希，避免不同数据集的同名标注文件共用一个日志
+                stem = os.path.splitext(os.path.basename(annot_path))[0]
+                digest = hashlib.md5(os.path.abspath(annot_path).encode('utf-8')).hexdigest()[:8]
+                autosave_path = os.path.join(os.path.expanduser("~"), f"{stem}_{digest}_autosave.txt")
+        self.autosave_path = autosave_path
         self.annot_data = None              # 存储 COCO 标注 JSON 数据
         self.image_info = []                # 存储图像信息：(image_id, file_name, annotations)
         self.current_index = 0              # 当前显示图像的索引
-        self.classifications = {}           # 记录分类结果：{image_name: "密集" / "稀疏"}
+        self.classifications = {}           # 记录分类结果：{image_id: "密集" / "稀疏"}
+        self._id_to_name = {}               # 图像 ID 到文件名的映射（导出时使用）
+        self._name_to_id = {}               # 文件名到图像 ID 的映射（导入时使用）
+        self._journal = None                # 自动保存日志文件，首次保存分类时才打开
+        self._journal_disabled = False      # 日志无法写入时不再重复尝试
+        self.prefetch_count = 4             # 切换到下一张时预取后续图像的数量
+        self._prefetch_pool = QThreadPool(self)
+        self._prefetching = set()           # 正在预取的缓存键，避免重复提交
         
         # 设置应用样式
         self.setStyle(QStyleFactory.create('Fusion'))
         
+        # 缓存已绘制标注并缩放好的图像，来回切换时无需重新解码（单位 KB，共 256 MB）
+        QPixmapCache.setCacheLimit(256 * 1024)
+        
         # 解析 COCO 标注
         self.load_annotations()
         
+        # 从自动保存日志恢复上次的分类进度
+        self.load_journal()
+        
         # 初始化 UI
         self.init_ui()
         
@@ -53,9 +181,7 @@ class COCOAnnotator(QMainWindow):
         """快速分类并自动保存"""
         if classification == "稀疏":
             self.sparse_check.setChecked(True)
-            self.dense_check.setChecked(False)
         else:
-            self.sparse_check.setChecked(False)
             self.dense_check.setChecked(True)
         self.save_classification()
 
@@ -66,11 +192,14 @@ class COCOAnnotator(QMainWindow):
 
     def load_annotations(self):
         """解析 COCO 标注 JSON 文件"""
-        with open(self.annot_path, 'r', encoding='utf-8') as f:
-            self.annot_data = json.load(f)
+        # 一次性读入后交给 orjson 解析，比标准库 json 更快且占用内存更少
+        with open(self.annot_path, 'rb') as f:
+            self.annot_data = orjson.loads(f.read())
         
-        # 建立图像 ID 到文件名的映射
+        # 建立图像 ID 与文件名的双向映射
         img_id_to_name = {img["id"]: img["file_name"] for img in self.annot_data["images"]}
+        self._id_to_name = img_id_to_name
+        self._name_to_id = {file_name: img_id for img_id, file_name in img_id_to_name.items()}
         
         # 按图像分组标注
         anns_by_img = {}
@@ -120,9 +249,15 @@ class COCOAnnotator(QMainWindow):
         self.sparse_check.setStyleSheet("QCheckBox { font-size: 14px; }")
         self.dense_check.setStyleSheet("QCheckBox { font-size: 14px; }")
         
-        # 确保只能选一个
-        self.sparse_check.stateChanged.connect(lambda: self.single_check(self.sparse_check))
-        self.dense_check.stateChanged.connect(lambda: self.single_check(self.dense_check))
+        # 确保只能选一个（互斥按钮组由 Qt 内部处理，无需 Python 回调）
+        self.classification_group = QButtonGroup(self)
+        self.classification_group.setExclusive(True)
+        self.classification_group.addButton(self.sparse_check, 1)
+        self.classification_group.addButton(self.dense_check, 2)
+        # 互斥按钮组不允许点击取消已选中的按钮，这里恢复“再次点击取消分类”的操作
+        self._pressed_was_checked = False
+        self.classification_group.buttonPressed.connect(self.on_classification_pressed)
+        self.classification_group.buttonClicked.connect(self.on_classification_clicked)
         
         classification_layout = QHBoxLayout()
         classification_layout.addWidget(self.sparse_check)
@@ -171,13 +306,21 @@ class COCOAnnotator(QMainWindow):
         
         main_layout.addLayout(button_layout)
 
-    def single_check(self, checked_box):
-        """确保只有一个 CheckBox 被选中"""
-        if checked_box.isChecked():
-            if checked_box == self.sparse_check:
-                self.dense_check.setChecked(False)
-            else:
-                self.sparse_check.setChecked(False)
+    def on_classification_pressed(self, button):
+        """记录按下时按钮是否已选中（点击完成后已无法区分）"""
+        self._pressed_was_checked = button.isChecked()
+
+    def on_classification_clicked(self, button):
+        """再次点击已选中的分类时取消勾选"""
+        if self._pressed_was_checked:
+            self.clear_classification_checks()
+
+    def clear_classification_checks(self):
+        """取消所有分类勾选（互斥按钮组不允许直接取消已选中的按钮，需临时关闭互斥）"""
+        self.classification_group.setExclusive(False)
+        self.sparse_check.setChecked(False)
+        self.dense_check.setChecked(False)
+        self.classification_group.setExclusive(True)
 
     def update_progress(self):
         """更新进度条"""
@@ -187,27 +330,103 @@ class COCOAnnotator(QMainWindow):
         self.progress_bar.setValue(classified)
 
     def import_progress(self):
-        """从文本文件导入之前的分类进度"""
+        """从导出文件导入之前的分类进度，并用自动保存日志补上导出之后的分类"""
         options = QFileDialog.Options()
         file_path, _ = QFileDialog.getOpenFileName(
-            self, "导入进度", "", "Text Files (*.txt)", options=options
+            self, "导入进度", "", "JSON Files (*.json);;Text Files (*.txt)", options=options
         )
         
         if not file_path:
             return
             
         try:
-            with open(file_path, 'r', encoding='utf-8') as f:
-                for line in f:
+            with open(file_path, 'rb') as f:
+                data = f.read()
+            if data.lstrip().startswith(b'{'):
+                # JSON 格式：{image_name: classification}
+                imported = orjson.loads(data)
+            else:
+                # 兼容旧版 "image_name: classification" 文本格式
+                imported = {}
+                for line in data.decode('utf-8').splitlines():
                     if ':' in line:
                         image_name, classification = line.strip().split(':')
-                        self.classifications[image_name.strip()] = classification.strip()
+                        imported[image_name.strip()] = classification.strip()
+            # 忽略不属于当前标注文件的图像
+            name_to_id = self._name_to_id
+            self.classifications.update(
+                (name_to_id[image_name], classification)
+                for image_name, classification in imported.items()
+                if image_name in name_to_id
+            )
             
+            self.load_journal()
             self.update_progress()
             self.show_image()  # 刷新显示
         except Exception as e:
             print(f"导入进度文件时出错: {str(e)}")
 
+    def write_journal(self, file_name, classification):
+        """追加一条记录到自动保存日志（空分类表示取消），首次调用时才打开日志文件"""
+        if self._journal_disabled:
+            return
+        try:
+            if self._journal is None:
+                # 行缓冲追加写入，每次分类只产生一次 write 调用
+                self._journal = open(self.autosave_path, 'a', encoding='utf-8', buffering=1)
+            self._journal.write(f"{file_name}\t{classification}\n")
+        except OSError as e:
+            # 磁盘已满、挂载点被移除等情况下不中断标注，只停用自动保存
+            print(f"无法写入自动保存日志 {self.autosave_path}: {str(e)}")
+            self._journal_disabled = True
+
+    def load_journal(self):
+        """按写入顺序回放自动保存日志，后写入的记录覆盖先前的记录"""
+        if not os.path.exists(self.autosave_path):
+            return
+        try:
+            # 异常退出可能留下被截断的最后一行，无法解码的字节替换掉，该行随后会被跳过
+            with open(self.autosave_path, 'r', encoding='utf-8', errors='replace', buffering=1 << 17) as f:
+                for line in f:
+                    image_name, sep, classification = line.rstrip('\n').partition('\t')
+                    image_id = self._name_to_id.get(image_name)
+                    if not sep or image_id is None or classification not in _JOURNAL_VALUES:
+                        continue
+                    if classification:
+                        self.classifications[image_id] = classification
+                    else:
+                        # 空分类表示该图像的分类已被取消
+                        self.classifications.pop(image_id, None)
+        except OSError as e:
+            # 日志无法读取时照常启动，只是不恢复进度
+            print(f"无法读取自动保存日志 {self.autosave_path}: {str(e)}")
+
+    def cache_key(self, file_name):
+        """图像缓存键，包含显示区域尺寸，窗口大小变化后会重新生成"""
+        return f"{file_name}:{self.image_label.width()}x{self.image_label.height()}"
+
+    def prefetch_images(self, start):
+        """在后台线程中预先渲染从 start 开始的若干张图像"""
+        end = min(len(self.image_info), start + self.prefetch_count)
+        for index in range(max(0, start), end):
+            img_info = self.image_info[index]
+            key = self.cache_key(img_info["file_name"])
+            if key in self._prefetching or QPixmapCache.find(key) is not None:
+                continue
+            job = _PrefetchJob(
+                key, os.path.join(self.image_dir, img_info["file_name"]), img_info["annotations"],
+                self.image_label.width(), self.image_label.height()
+            )
+            job.signals.finished.connect(self.on_prefetched)
+            self._prefetching.add(key)
+            self._prefetch_pool.start(job)
+
+    def on_prefetched(self, key, q_image):
+        """预取完成（GUI 线程）：转换为 QPixmap 并放入缓存；加载失败时只清除预取标记"""
+        self._prefetching.discard(key)
+        if not q_image.isNull():
+            QPixmapCache.insert(key, QPixmap.fromImage(q_image))
+
     def show_image(self):
         """显示当前索引的图像，并绘制标注"""
         if self.current_index < 0 or self.current_index >= len(self.image_info):
@@ -221,53 +440,28 @@ class COCOAnnotator(QMainWindow):
         # 更新窗口标题显示当前图片信息
         self.setWindowTitle(f"COCO 数据集标注筛选工具 - {file_name} ({self.current_index + 1}/{len(self.image_info)})")
         
-        # 加载图像
-        image = cv2.imread(image_path)
-        if image is None:
-            print(f"无法加载图像: {image_path}")
-            return
-        
-        # 绘制标注（目标框 + 类别）
-        for ann in img_info["annotations"]:
-            bbox = ann["bbox"]  # [x, y, w, h]
-            category_id = ann["category_id"]
-            # 根据 category_id 映射到类别名称（如果需要更友好的显示，可完善 self.annot_data["categories"] 的解析）
-            category_name = f"类别 {category_id}"  
-            
-            # 绘制矩形框
-            x, y, w, h = map(int, bbox)
-            cv2.rectangle(image, (x, y), (x + w, y + h), (0, 255, 0), 2)
-            
-            # 绘制类别名称
-            cv2.putText(
-                image, category_name, (x, y - 10),
-                cv2.FONT_HERSHEY_SIMPLEX, 0.5, (0, 255, 0), 2
+        key = self.cache_key(file_name)
+        scaled_pixmap = QPixmapCache.find(key)
+        if scaled_pixmap is None:
+            q_image = render_image(
+                image_path, img_info["annotations"],
+                self.image_label.width(), self.image_label.height()
             )
-
-        # 转换图像格式用于 PyQt 显示
-        height, width, channel = image.shape
-        bytes_per_line = 3 * width
-        q_image = QImage(
-            image.data, width, height, bytes_per_line,
-            QImage.Format_RGB888
-        ).rgbSwapped()  # OpenCV 是 BGR，转成 RGB 用于 PyQt
-        
-        pixmap = QPixmap.fromImage(q_image)
-        scaled_pixmap = pixmap.scaled(
-            self.image_label.width(), self.image_label.height(),
-            Qt.KeepAspectRatio, Qt.SmoothTransformation
-        )
+            if q_image is None:
+                print(f"无法加载图像: {image_path}")
+                return
+            scaled_pixmap = QPixmap.fromImage(q_image)
+            QPixmapCache.insert(key, scaled_pixmap)
         self.image_label.setPixmap(scaled_pixmap)
 
         # 自动勾选之前保存的分类
-        image_name = file_name
-        if image_name in self.classifications:
-            classification = self.classifications[image_name]
-            self.sparse_check.setChecked(classification == "稀疏")
-            self.dense_check.setChecked(classification == "密集")
+        classification = self.classifications.get(img_info["id"])
+        if classification == "稀疏":
+            self.sparse_check.setChecked(True)
+        elif classification == "密集":
+            self.dense_check.setChecked(True)
         else:
-            self.sparse_check.setChecked(False)
-            self.dense_check.setChecked(False)
+            self.clear_classification_checks()
 
     def show_prev_image(self):
         """显示上一张图像"""
@@ -278,35 +472,53 @@ class COCOAnnotator(QMainWindow):
         """显示下一张图像"""
         self.current_index = min(len(self.image_info) - 1, self.current_index + 1)
         self.show_image()
+        self.prefetch_images(self.current_index + 1)
 
     def save_classification(self):
         """保存当前图像的分类结果"""
         img_info = self.image_info[self.current_index]
-        file_name = img_info["file_name"]
+        image_id = img_info["id"]
         
         if self.sparse_check.isChecked():
-            self.classifications[file_name] = "稀疏"
+            classification = "稀疏"
         elif self.dense_check.isChecked():
-            self.classifications[file_name] = "密集"
+            classification = "密集"
         else:
-            if file_name in self.classifications:
-                del self.classifications[file_name]
+            classification = ""
+        
+        if classification:
+            self.classifications[image_id] = classification
+        elif image_id in self.classifications:
+            del self.classifications[image_id]
+        
+        # 追加写入自动保存日志，日志中记录文件名
+        self.write_journal(img_info["file_name"], classification)
         
         self.update_progress()
 
     def export_results(self):
-        """导出分类结果到 TXT 文件"""
+        """导出分类结果到 JSON 文件：{image_name: classification}"""
         options = QFileDialog.Options()
         file_path, _ = QFileDialog.getSaveFileName(
-            self, "导出结果", "", "Text Files (*.txt)", options=options
+            self, "导出结果", "", "JSON Files (*.json)", options=options
         )
         
         if not file_path:
             return
         
-        with open(file_path, 'w', encoding='utf-8') as f:
-            for image_name, classification in self.classifications.items():
-                f.write(f"{image_name}: {classification}\n")
+        id_to_name = self._id_to_name
+        results = {id_to_name[image_id]: classification for image_id, classification in self.classifications.items()}
+        # 序列化为一个整体后一次写入
+        with open(file_path, 'wb') as f:
+            f.write(orjson.dumps(results))
+
+    def closeEvent(self, event):
+        """关闭窗口时停止预取并关闭自动保存日志"""
+        self._prefetch_pool.clear()
+        self._prefetch_pool.waitForDone()
+        if self._journal is not None:
+            self._journal.close()
+        super(COCOAnnotator, self).closeEvent(event)
 
 
 if __name__ == "__main__":
@@ -1,109 +1,239 @@
 import os
 import xml.etree.ElementTree as ET
-import json
 import shutil
-
-
-def voc_to_coco(voc_root, output_root):
-    sets = ['train', 'val']
-    for set_name in sets:
-        images = []
-        annotations = []
-        categories = []
-        category_id = 1
-        annotation_id = 1
-
-        image_dir = os.path.join(voc_root, 'JPEGImages')
-        annotation_dir = os.path.join(voc_root, 'Annotations')
-        set_file = os.path.join(voc_root, 'ImageSets', 'Main', f'{set_name}.txt')
-
-        with open(set_file, 'r') as f:
-            image_ids = f.read().strip().splitlines()
-
-        category_names = set()
-        for image_id in image_ids:
-            image_path = os.path.join(image_dir, f'{image_id}.jpg')
-            annotation_path = os.path.join(annotation_dir, f'{image_id}.xml')
-
-            if not os.path.exists(image_path) or not os.path.exists(annotation_path):
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from functools import partial
+from multiprocessing import Pool
+
+import imagesize
+import numpy as np
+import orjson
+
+
+class _CatRef:
+    """类别引用：同一类别的所有标注共享一个实例，类别排序完成后统一回填 id"""
+    __slots__ = ('name', 'id')
+
+    def __init__(self, name):
+        self.name = name
+        self.id = None
+
+
+@dataclass(slots=True)
+class _Image:
+    """COCO images 条目；orjson 按字段声明顺序直接序列化"""
+    id: int
+    file_name: str
+    width: int
+    height: int
+
+
+@dataclass(slots=True)
+class _Annotation:
+    """COCO annotations 条目，category_id 在序列化前为 _CatRef"""
+    id: int
+    image_id: int
+    category_id: _CatRef
+    bbox: list
+    area: int
+    iscrowd: int
+    difficult: int
+
+
+def _encode_default(obj):
+    """orjson 序列化钩子：把 _CatRef 输出为最终的 category_id"""
+    if isinstance(obj, _CatRef):
+        return obj.id
+    raise TypeError
+
+
+def _link_or_copy(src, dst):
+    """把 src 迁移到 dst：优先硬链接，其次 copy_file_range（btrfs/xfs 上可触发 reflink），最后普通复制"""
+    try:
+        os.link(src, dst)
+        return
+    except FileExistsError:
+        # 重复运行时目标已存在：已是同一文件则跳过，否则删除后重新链接
+        if os.path.samefile(src, dst):
+            return
+        os.remove(dst)
+        try:
+            os.link(src, dst)
+            return
+        except OSError:
+            pass
+    except OSError:
+        # 跨文件系统或文件系统不支持硬链接
+        pass
+
+    if hasattr(os, 'copy_file_range'):
+        try:
+            with open(src, 'rb') as fsrc, open(dst, 'wb') as fdst:
+                remaining = os.fstat(fsrc.fileno()).st_size
+                while remaining > 0:
+                    copied = os.copy_file_range(fsrc.fileno(), fdst.fileno(), remaining)
+                    if copied == 0:
+                        break
+                    remaining -= copied
+            if remaining == 0:
+                return
+        except OSError:
+            pass
+
+    shutil.copyfile(src, dst)
+
+
+def _process_one(image_id, image_dir, annotation_dir):
+    """解析单张图像的 VOC 标注，返回 (image, annotations, object_names)；文件缺失时返回 None
+
+    object_names 与 annotations 一一对应，category_id 在汇总时填入
+    """
+    image_path = os.path.join(image_dir, f'{image_id}.jpg')
+    annotation_path = os.path.join(annotation_dir, f'{image_id}.xml')
+
+    if not os.path.exists(image_path) or not os.path.exists(annotation_path):
+        return None
+
+    width = height = None
+    object_names = []
+    # 每个 <object> 依次追加 xmin, ymin, xmax, ymax, difficult 五个原始字符串，整文件解析完后统一转换
+    raw_values = []
+    # 流式解析 XML：只在 <size> / <object> 结束时读取所需字段，处理完立即 clear 释放子节点
+    # 使用 128KB 读缓冲，常见的标注文件一次 read 即可读完
+    with open(annotation_path, 'rb', buffering=1 << 17) as f:
+        for _, elem in ET.iterparse(f, events=('end',)):
+            if elem.tag == 'size':
+                try:
+                    width = int(elem.find('width').text)
+                    height = int(elem.find('height').text)
+                except (AttributeError, TypeError, ValueError):
+                    width = height = None
+                elem.clear()
+            elif elem.tag == 'object':
+                object_names.append(elem.find('name').text)
+                bndbox = elem.find('bndbox')
+                raw_values.append(bndbox.find('xmin').text)
+                raw_values.append(bndbox.find('ymin').text)
+                raw_values.append(bndbox.find('xmax').text)
+                raw_values.append(bndbox.find('ymax').text)
+                raw_values.append(elem.find('difficult').text)
+                elem.clear()
+
+    # 向量化计算目标框的宽高和面积
+    n = len(object_names)
+    values = np.fromiter(raw_values, dtype=np.int64, count=5 * n).reshape(n, 5)
+    w = values[:, 2] - values[:, 0]
+    h = values[:, 3] - values[:, 1]
+    bboxes = np.column_stack((values[:, 0], values[:, 1], w, h))
+    areas = w * h
+
+    annotations = []
+    for bbox, area, difficult in zip(bboxes.tolist(), areas.tolist(), values[:, 4].tolist()):
+        annotations.append(_Annotation(
+            id=None,
+            image_id=None,
+            category_id=None,
+            bbox=bbox,
+            area=area,
+            iscrowd=0,
+            difficult=difficult
+        ))
+
+    # 优先使用 XML 中的 <size>，缺失或非法时只解析 JPEG 文件头获取尺寸，不做完整解码
+    if width is None or height is None:
+        width, height = imagesize.get(image_path)
+
+    # id 在汇总结果时统一分配，保证与串行处理时一致
+    image = _Image(
+        id=None,
+        file_name=f'{image_id}.jpg',
+        width=width,
+        height=height
+    )
+
+    return image, annotations, object_names
+
+
+def process_set(set_name, voc_root, output_root):
+    """把 VOC 的一个划分（train / val）转换为 COCO 格式，各划分之间互不依赖"""
+    # XML 解析和文件复制都以 I/O 为主，系统调用期间会释放 GIL，用线程池即可重叠
+    max_workers = (os.cpu_count() or 1) * 2
+    images = []
+    annotations = []
+    categories = []
+    category_id = 1
+    annotation_id = 1
+
+    image_dir = os.path.join(voc_root, 'JPEGImages')
+    annotation_dir = os.path.join(voc_root, 'Annotations')
+    set_file = os.path.join(voc_root, 'ImageSets', 'Main', f'{set_name}.txt')
+
+    with open(set_file, 'r') as f:
+        image_ids = f.read().strip().splitlines()
+
+    # 类别名称到类别引用的映射，解析时按需创建
+    category_refs = {}
+    process_one = partial(_process_one, image_dir=image_dir, annotation_dir=annotation_dir)
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        # executor.map 按输入顺序返回结果，id 分配与串行处理完全一致
+        for result in executor.map(process_one, image_ids):
+            if result is None:
                 continue
-
-            tree = ET.parse(annotation_path)
-            root = tree.getroot()
-
-            width = int(root.find('size').find('width').text)
-            height = int(root.find('size').find('height').text)
-
-            image = {
-                'id': len(images) + 1,
-                'file_name': f'{image_id}.jpg',
-                'width': width,
-                'height': height
-            }
+            image, image_annotations, object_names = result
+            image.id = len(images) + 1
             images.append(image)
-
-            # 遍历当前标注文件里的每个 <object> 标签
-            for obj in root.findall('object'):
-                category_name = obj.find('name').text
-                category_names.add(category_name)
-                difficult = int(obj.find('difficult').text)
-                bndbox = obj.find('bndbox')
-                xmin = int(bndbox.find('xmin').text)
-                ymin = int(bndbox.find('ymin').text)
-                xmax = int(bndbox.find('xmax').text)
-                ymax = int(bndbox.find('ymax').text)
-                w = xmax - xmin
-                h = ymax - ymin
-
-                annotation = {
-                    'id': annotation_id,
-                    'image_id': image['id'],
-                    'category_id': None,
-                    'bbox': [xmin, ymin, w, h],
-                    'area': w * h,
-                    'iscrowd': 0,
-                    'difficult': difficult,
-                    # 新增字段，临时保存当前目标的类别名称
-                    'category_name': category_name  
-                }
+            for annotation, category_name in zip(image_annotations, object_names):
+                category_ref = category_refs.get(category_name)
+                if category_ref is None:
+                    category_ref = category_refs[category_name] = _CatRef(category_name)
+                annotation.id = annotation_id
+                annotation.image_id = image.id
+                annotation.category_id = category_ref
                 annotations.append(annotation)
                 annotation_id += 1
 
-        # 构建类别信息
-        for i, category_name in enumerate(sorted(list(category_names))):
-            category = {
-                'id': category_id,
-                'name': category_name,
-               'supercategory': 'none'
-            }
-            categories.append(category)
-            category_id += 1
-
-        # 填充 annotation 里的 category_id
-        for ann in annotations:
-            category_name = ann['category_name']
-            # 根据类别名称找到对应的 category_id
-            ann['category_id'] = [cat['id'] for cat in categories if cat['name'] == category_name][0]
-            # 移除临时保存的类别名称字段（可选，若不想在最终 COCO 标注里保留）
-            del ann['category_name']  
-
-        output_images_dir = os.path.join(output_root, f'{set_name}2024')
-        output_annotations_dir = os.path.join(output_root, 'annotations')
-        os.makedirs(output_images_dir, exist_ok=True)
-        os.makedirs(output_annotations_dir, exist_ok=True)
-
-        # 复制图像文件
-        for image in images:
-            shutil.copy(os.path.join(image_dir, image['file_name']), os.path.join(output_images_dir, image['file_name']))
-
-        # 构建并保存 COCO 格式数据
-        coco_data = {
-            'images': images,
-            'annotations': annotations,
-            'categories': categories
+    # 构建类别信息，同时回填类别引用的 id（只遍历类别，无需再遍历全部标注）
+    for category_name in sorted(category_refs):
+        category_refs[category_name].id = category_id
+        category = {
+            'id': category_id,
+            'name': category_name,
+           'supercategory': 'none'
         }
-        with open(os.path.join(output_annotations_dir, f'instances_{set_name}2024.json'), 'w') as f:
-            json.dump(coco_data, f, indent=4)
+        categories.append(category)
+        category_id += 1
+
+    output_images_dir = os.path.join(output_root, f'{set_name}2024')
+    output_annotations_dir = os.path.join(output_root, 'annotations')
+    os.makedirs(output_images_dir, exist_ok=True)
+    os.makedirs(output_annotations_dir, exist_ok=True)
+
+    # 迁移图像文件（同一文件系统下为硬链接，不再重复读写图像内容）
+    copy_jobs = [
+        (os.path.join(image_dir, image.file_name), os.path.join(output_images_dir, image.file_name))
+        for image in images
+    ]
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        # 消费结果以便把复制过程中的异常抛出来
+        list(executor.map(lambda job: _link_or_copy(*job), copy_jobs))
+
+    # 构建并保存 COCO 格式数据
+    coco_data = {
+        'images': images,
+        'annotations': annotations,
+        'categories': categories
+    }
+    # orjson 为 C 实现的序列化器，直接输出 UTF-8 字节，缩进改为 2 以减少写入量；写缓冲 1MB
+    with open(os.path.join(output_annotations_dir, f'instances_{set_name}2024.json'), 'wb', buffering=1 << 20) as f:
+        f.write(orjson.dumps(coco_data, default=_encode_default, option=orjson.OPT_INDENT_2))
+
+
+def voc_to_coco(voc_root, output_root):
+    sets = ['train', 'val']
+    # 各划分的 id 相互独立，用多进程同时转换
+    with Pool(len(sets)) as pool:
+        pool.map(partial(process_set, voc_root=voc_root, output_root=output_root), sets)
 
 
 if __name__ == "__main__":